@@ -1,4 +1,4 @@
-from .utils import safe_post_request, depaginated_request
+from .utils import minify_query, safe_post_request, depaginated_request
 from .oauth_utils import get_oauth_token
 import json
 import argparse
@@ -10,7 +10,8 @@ REQUIRED_CONFIG_KEYS = [
     'client_secret'
 ]
 
-user_query = '''
+# Templates for str.format; minified up front so the formatted queries are sent compact
+USER_QUERY_TEMPLATE = minify_query('''
 query ({0}) {{
     User ({1}) {{
     id
@@ -37,9 +38,9 @@ query ({0}) {{
     }}
   }}
 }}
-'''
+''')
 
-query = '''
+ACTIVITY_QUERY_TEMPLATE = minify_query('''
 query ($userId: Int!, $page: Int, $perPage: Int, $mediaTypes: [ActivityType]) {{
   Page (page: $page, perPage: $perPage) {{
     pageInfo {{
@@ -62,7 +63,7 @@ query ($userId: Int!, $page: Int, $perPage: Int, $mediaTypes: [ActivityType]) {{
       }}
     }}
   }}
-}}'''
+}}''')
 
 # python activity.py -amef activity.json -n robert054321 -t romaji english native -o config.json -d
 if __name__ == '__main__':
@@ -96,7 +97,7 @@ if __name__ == '__main__':
     output = []
 
     user_json = safe_post_request(
-            {'query': user_query.format(
+            {'query': USER_QUERY_TEMPLATE.format(
                  '$userId: Int!' if args.username is None else '$username: String',
                  'id: $userId' if args.username is None else 'name: $username'),
              'variables': {'userId': args.userId} if args.username is None else {'username': args.username}},
@@ -104,7 +105,7 @@ if __name__ == '__main__':
     output.append(json.dumps(user_json))
 
     user_id = user_json['User']['id']
-    activity_list = depaginated_request(query=query.format('\n'.join(args.title_type)),
+    activity_list = depaginated_request(query=ACTIVITY_QUERY_TEMPLATE.format('\n'.join(args.title_type)),
                                         variables={'userId': user_id, 'mediaTypes': args.media_types})
     if not args.integer_datetime:
         activity_list = [(activity | {'createdAt': datetime.fromtimestamp(activity['createdAt']).strftime('%Y-%m-%d %H:%M:%S')})
@@ -38,7 +38,7 @@ if __name__ == '__main__':
     if args.paginated:
         if any([re.match(paginate_var, query) is None for paginate_var in REQUIRED_PAGINATE_VARIABLES]):
             raise Exception('Query does not contain page and perPage as variables')
-        user_json = depaginated_request(query, None, oauth_token)
+        user_json = list(depaginated_request(query, None, oauth_token))
     else:
         user_json = safe_post_request({'query': query}, oauth_token)
 
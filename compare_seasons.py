@@ -2,42 +2,75 @@
 
 import argparse
 from datetime import datetime
+from itertools import chain
 
-from .utils import safe_post_request, depaginated_request
-from .upcoming_sequels import get_user_id_by_name, get_season_shows
-
-
-def get_user_shows(user_id, status='COMPLETED'):
-    """Given an AniList user ID, fetch the user's anime with given status (default COMPLETED), returning a dict of
-     show ID: show JSONs sorted by score (desc).
-     Include season and seasonYear.
-     TODO: Proper object-oriented library with e.g. User.shows(fields=[...])
-     """
-    query = '''
-query ($userId: Int, $status: MediaListStatus, $page: Int, $perPage: Int) {
-    Page (page: $page, perPage: $perPage) {
-        pageInfo {
-            hasNextPage
-        }
-        # Note that a MediaList object is actually a single list entry, hence the need for pagination
-        mediaList(userId: $userId, type: ANIME, status: $status, sort: SCORE_DESC) {
-            media {
-                id
-                title {
-                    english
-                    romaji
+from .utils import minify_query, safe_post_request, get_cached, set_cached
+from .upcoming_sequels import get_season_shows
+
+MAX_CHUNK_SIZE = 500  # The anilist API's max MediaListCollection chunk size
+
+
+USER_SHOWS_CHUNKED_QUERY = minify_query('''
+query ($userId: Int, $userName: String, $statusIn: [MediaListStatus], $chunk: Int, $perChunk: Int) {
+    MediaListCollection(userId: $userId, userName: $userName, type: ANIME, status_in: $statusIn, chunk: $chunk,
+                        perChunk: $perChunk) {
+        hasNextChunk
+        lists {
+            entries {
+                media {
+                    id
+                    title {
+                        english
+                        romaji
+                    }
+                    season
+                    seasonYear
                 }
-                season
-                seasonYear
+                score
             }
-            score
         }
     }
-}'''
+}''')
+
+
+def get_user_shows_chunked(user_id=None, status_in=('COMPLETED',), username=None):
+    """Given an AniList user ID or username, fetch the user's anime with any of the given statuses (default COMPLETED),
+    returning a list of show JSONs with score, season, and seasonYear (not sorted by score).
+
+    Uses MediaListCollection, which returns up to 500 list entries per request instead of paginating over mediaList.
+    TODO: Proper object-oriented library with e.g. User.shows(fields=[...])
+    """
+    variables = {'userId': user_id, 'userName': username, 'statusIn': list(status_in), 'perChunk': MAX_CHUNK_SIZE}
+
+    # Cache the collected list as a single entry rather than per chunk, since stitching together chunks cached at
+    # different times could skip or duplicate list entries
+    cache_key = {'query': USER_SHOWS_CHUNKED_QUERY, 'variables': variables}
+    user_shows = get_cached(cache_key)
+    if user_shows is not None:
+        return user_shows
 
-    # For some reason anilist returns duplicates when querying mediaList sometimes so convert through an ID dict first
-    return list({list_entry['media']['id']: {**list_entry['media'], 'score': list_entry['score']}  # Stuff score in too
-                for list_entry in depaginated_request(query=query, variables={'userId': user_id, 'status': status})}.values())
+    shows_dict = {}
+    chunk_num = 1  # Note that chunks are 1-indexed
+    while True:
+        response_data = safe_post_request({'query': USER_SHOWS_CHUNKED_QUERY,
+                                           'variables': {**variables, 'chunk': chunk_num}}, cacheable=False)
+        collection = response_data['MediaListCollection']
+
+        # Entries can show up in multiple lists (e.g. custom lists), so dedupe by show ID
+        for media_list in collection['lists']:
+            for list_entry in media_list['entries']:
+                if list_entry['media']['id'] not in shows_dict:
+                    shows_dict[list_entry['media']['id']] = {**list_entry['media'], 'score': list_entry['score']}
+
+        if not collection['hasNextChunk']:
+            break
+
+        chunk_num += 1
+
+    user_shows = list(shows_dict.values())
+    set_cached(cache_key, user_shows)
+
+    return user_shows
 
 
 if __name__ == '__main__':
@@ -49,14 +82,26 @@ if __name__ == '__main__':
     parser.add_argument('seasons', nargs='+',
                         help='Seasons or years to compare, formatted as e.g. 2021 or "Winter 2021".\n'
                              'Seasons are Winter, Spring, Summer, Fall.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't read or write the local cache of AniList API responses.")
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help="Ignore any cached AniList API responses, re-fetching (and re-caching) them.")
     args = parser.parse_args()
 
-    user_id = get_user_id_by_name(args.username)
+    safe_post_request.use_cache = not args.no_cache
+    safe_post_request.refresh_cache = args.refresh_cache
+
+    # Fetch the user's watching/completed anime and their scores. Looking the list up by username directly saves a
+    # separate query for the user's ID
+    user_shows = get_user_shows_chunked(username=args.username, status_in=('COMPLETED', 'CURRENT'))
 
-    # Fetch the user's watching/completed anime and their scores
-    user_shows = []
-    for status in ('COMPLETED', 'CURRENT'):
-        user_shows.extend(get_user_shows(user_id, status=status))
+    # Group the shows by season and by year in one pass, sorting up front so each group is already in score order
+    user_shows.sort(key=lambda x: x['score'], reverse=True)
+    shows_by_season = {}
+    shows_by_year = {}
+    for show in user_shows:
+        shows_by_season.setdefault((show['season'], show['seasonYear']), []).append(show)
+        shows_by_year.setdefault(show['seasonYear'], []).append(show)
 
     # Fetch the user's watching/completed anime from each season and their scores
     seasonal_user_shows = []
@@ -64,26 +109,25 @@ if __name__ == '__main__':
         *season, year = season_str.split()  # Handle both "year" and "season year"
         year = int(year)
         if season:
-            season = season[0].upper()
-
-        season_user_shows = [show for show in user_shows
-                             if show['seasonYear'] == year and (show['season'] == season or not season)]
-        season_user_shows.sort(key=lambda x: x['score'], reverse=True)
+            season_user_shows = shows_by_season.get((season[0].upper(), year), [])
+        else:
+            season_user_shows = shows_by_year.get(year, [])
         seasonal_user_shows.append(season_user_shows)
 
         for show in season_user_shows:
             if show['id'] == 21732:
                 print(show)
 
-    # Printout the info
-    def pad(s, width):
-        return str(s)[:width].ljust(width)
+    # Printout the info. Build the format strings once; each column is left-justified and truncated to its width
+    header_format = '   '.join(['{!s:<30.30}'] * len(args.seasons))
+    row_format = '   '.join(['{!s:<3.3}  {!s:<25.25}'] * len(args.seasons))  # Score, title
 
-    print('   '.join(pad(season, 30) for season in args.seasons))
+    print(header_format.format(*args.seasons))
     print("=" * 28 * len(args.seasons))
     for i in range(max(len(shows) for shows in seasonal_user_shows)):
-        print('   '.join(pad(shows[i]['score'], 3) + '  ' + pad(shows[i]['title']['english'] or shows[i]['title']['romaji'], 25)
-                         if i < len(shows) else 30 * ' '
-                         for shows in seasonal_user_shows))
+        print(row_format.format(*chain.from_iterable(
+            (shows[i]['score'], shows[i]['title']['english'] or shows[i]['title']['romaji']) if i < len(shows)
+            else ('', '')
+            for shows in seasonal_user_shows)))
 
     print(f"\nTotal queries: {safe_post_request.total_queries}")
@@ -1,14 +1,65 @@
 import argparse
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
 import staff_types
-from .utils import safe_post_request, depaginated_request, dict_intersection
+from .utils import (MAX_PAGE_SIZE, LONG_CACHE_TTL, minify_query, safe_post_request, depaginated_request,
+                    batched_media_query, get_cached, set_cached, dict_intersection)
 
 STAFF_COL_WIDTH = 20
 SHOW_COL_WIDTH = 40
 COL_SEP = 3
 NUM_SHOWS_ALL_STAFF = 5  # How many shows to list for most total shared staff
 NUM_SHOWS_SUB_STAFF = 3  # How many shows to list for most of each sub-category of staff
+MAX_WORKERS = 4  # Concurrent staff lookups; more than this mostly just hits the API's rate limit sooner
+
+# Paginated queries for a show's staff and characters, shared between the standalone getters and get_show_bundle's
+# follow-up requests
+SHOW_STAFF_QUERY = minify_query('''
+query ($mediaId: Int, $page: Int, $perPage: Int) {
+    Media(id: $mediaId) {
+        staff(sort: RELEVANCE, page: $page, perPage: $perPage) {
+            pageInfo {
+                hasNextPage
+            }
+            # Direct `nodes` field is also available, but it includes duplicates per edge (e.g. one staff with two roles
+            # shows up twice even though nodes don't include role), so avoiding it to keep things intuitive.
+            edges {
+                node {
+                    id  # Names are only looked up for staff that end up listed; see get_staff_names
+                }
+                role
+            }
+        }
+    }
+}''')
+
+SHOW_CHARACTERS_QUERY = minify_query('''
+query ($mediaId: Int, $language: StaffLanguage, $page: Int, $perPage: Int) {
+    Media(id: $mediaId) {
+        characters(sort: [ROLE, RELEVANCE], page: $page, perPage: $perPage) {
+            pageInfo {
+                hasNextPage
+            }
+            edges {
+                node {  # Character
+                    name {
+                        full
+                    }
+                }
+                role  # MAIN, SUPPORTING, or BACKGROUND
+                voiceActorRoles(language: $language) {  # This is a list, but the API doesn't make us paginate it
+                    voiceActor {
+                        id  # Names are only looked up for VAs that end up listed; see get_staff_names
+                    }
+                    roleNotes
+                }
+            }
+        }
+    }
+}''')
+
 
 # Ideally we could sort on [SEARCH_MATCH, POPULARITY_DESC], but this doesn't seem to work as expected in the case of
 # shows with the exact same title (e.g. Golden Time); the less popular one is still returned.
@@ -18,32 +69,43 @@ def get_show(search, sort_by="SEARCH_MATCH"):
     Default sorts by closeness of the string match. Use e.g. POPULARITY_DESC for cases where shows share a name (e.g.
     "Golden Time" will by default return the one no one cares about).
     """
-    query = '''
-query ($search: String, $sort: MediaSort) {
-    Media(search: $search, type: ANIME, sort: [$sort]) {
-        id
-        title {
-            english
-            romaji
-        }
-    }
-}'''
-    result = safe_post_request({'query': query, 'variables': {'search': search, 'sort': sort_by}})
-    if result is not None:
-        result = result['Media']
+    return get_shows([search], sort_by=sort_by)[0]
 
-        # In case a show has no english title, fall back to romaji
-        title = result['title']['english'] if result['title']['english'] is not None else result['title']['romaji']
-        assert title is not None, f"API returned an untitled show for \"{search}\" (show ID: {result['id']})"
 
-        result = {'id': result['id'], 'title': title}
+SHOW_FIELDS = minify_query('''
+id
+title {
+    english
+    romaji
+}
+''')
 
-    return result
 
+def get_shows(searches, sort_by="SEARCH_MATCH"):
+    """Given a list of approximate show names, return a list of the closest-matching show for each, as in get_show.
+    All shows are looked up in as few requests as possible.
+    """
+    results = batched_media_query(media_args="search: $search, type: ANIME, sort: [$sort]",
+                                  fields=SHOW_FIELDS,
+                                  variables_list=[{'search': search} for search in searches],
+                                  variable_types={'search': "String", 'sort': "MediaSort"},
+                                  shared_variables={'sort': sort_by})
 
-def get_show_studios(show_id):
-    """Given a show ID, return a dict of its studios, formatted as id: {"name": "...", "roles": ["..."]}."""
-    query = '''
+    shows = []
+    for search, result in zip(searches, results):
+        if result is not None:
+            # In case a show has no english title, fall back to romaji
+            title = result['title']['english'] if result['title']['english'] is not None else result['title']['romaji']
+            assert title is not None, f"API returned an untitled show for \"{search}\" (show ID: {result['id']})"
+
+            result = {'id': result['id'], 'title': title}
+
+        shows.append(result)
+
+    return shows
+
+
+SHOW_STUDIOS_QUERY = minify_query('''
 query ($mediaId: Int) {
     Media(id: $mediaId) {
         studios {
@@ -56,14 +118,24 @@ query ($mediaId: Int) {
             }
         }
     }
-}'''
+}''')
+
+
+def get_show_studios(show_id):
+    """Given a show ID, return a dict of its studios, formatted as id: {"name": "...", "roles": ["..."]}."""
+    # the Media.studios API also does not seem to be paginated even though StudioConnection has pageInfo
+    response_data = safe_post_request({'query': SHOW_STUDIOS_QUERY, 'variables': {'mediaId': show_id}})
+    return studios_dict_from_edges(response_data['Media']['studios']['edges'])
+
+
+def studios_dict_from_edges(edges):
+    """Given the edges of a Media.studios query, return a dict of studios formatted as in get_show_studios."""
     # Since the API doesn't sort by isMain, handle main vs supporting studios separately, so we can return main
     # studio(s) at the front of the results
     main_studios_dict = {}
     supporting_studios_dict = {}
 
-    # the Media.studios API also does not seem to be paginated even though StudioConnection has pageInfo
-    for edge in safe_post_request({'query': query, 'variables': {'mediaId': show_id}})['Media']['studios']['edges']:
+    for edge in edges:
         if edge['isMain']:
             main_studios_dict[edge['node']['id']] = {'name': edge['node']['name'], 'roles': ["Main"]}
         else:
@@ -73,80 +145,92 @@ query ($mediaId: Int) {
 
 
 def get_show_production_staff(show_id):
-    """Given a show ID, return a dict of its production staff, formatted as id: {"name": "...", "roles": ["..."]}."""
-    query = '''
-query ($mediaId: Int, $page: Int, $perPage: Int) {
-    Media(id: $mediaId) {
-        staff(sort: RELEVANCE, page: $page, perPage: $perPage) {
-            pageInfo {
-                hasNextPage
-            }
-            # Direct `nodes` field is also available, but it includes duplicates per edge (e.g. one staff with two roles
-            # shows up twice even though nodes don't include role), so avoiding it to keep things intuitive.
-            edges {
-                node {
-                    id
-                    name {
-                        full
-                    }
-                }
-                role
-            }
-        }
-    }
-}'''
+    """Given a show ID, return a dict of its production staff, formatted as id: {"roles": ["..."]}.
+    Staff names aren't included, to keep responses small; use get_staff_names for any that are needed.
+    """
+    return staff_dict_from_edges(depaginated_request(query=SHOW_STAFF_QUERY, variables={'mediaId': show_id}))
+
+
+def staff_dict_from_edges(edges):
+    """Given the edges of a Media.staff query, return a dict of staff formatted as in get_show_production_staff."""
     staff_dict = {}
 
-    for edge in depaginated_request(query=query, variables={'mediaId': show_id}):
+    for edge in edges:
         # Account for staff potentially having multiple roles
         if edge['node']['id'] not in staff_dict:
-            staff_dict[edge['node']['id']] = {'name': edge['node']['name']['full'],
-                                              'roles': []}
+            staff_dict[edge['node']['id']] = {'roles': []}
 
         staff_dict[edge['node']['id']]['roles'].append(edge['role'])
 
     return staff_dict
 
 
-def get_show_voice_actors(show_id, language="JAPANESE"):
-    """Given a show ID, return a dict of its voice actors for the given language (default: "JAPANESE"), formatted as:
-    id: {"name": "...", "roles": ["MAIN: Edward Elric", "SUPPORTING: Edward Elric (child)"]}.
-    """
-    query = '''
-query ($mediaId: Int, $language: StaffLanguage, $page: Int, $perPage: Int) {
+SHOW_STAFF_IDS_QUERY = minify_query('''
+query ($mediaId: Int, $page: Int, $perPage: Int) {
     Media(id: $mediaId) {
-        characters(sort: [ROLE, RELEVANCE], page: $page, perPage: $perPage) {
+        staff(page: $page, perPage: $perPage) {
             pageInfo {
                 hasNextPage
             }
-            edges {
-                node {  # Character
-                    name {
-                        full
-                    }
-                }
-                role  # MAIN, SUPPORTING, or BACKGROUND
-                voiceActorRoles(language: $language) {  # This is a list, but the API doesn't make us paginate it
-                    voiceActor {
-                        id
-                        name {
-                            full
-                        }
-                    }
-                    roleNotes
-                }
+            nodes {  # Includes duplicates for staff with multiple roles, but we only want the set of IDs
+                id
             }
         }
     }
-}'''
+}''')
+
+
+def get_show_production_staff_ids(show_id):
+    """Given a show ID, return a set of its production staff's IDs. Cheaper than get_show_production_staff when the
+    roles aren't needed.
+    """
+    return {staff['id'] for staff in depaginated_request(query=SHOW_STAFF_IDS_QUERY, variables={'mediaId': show_id})}
+
+
+STAFF_NAMES_QUERY = minify_query('''
+query ($staffIds: [Int], $page: Int, $perPage: Int) {
+    Page (page: $page, perPage: $perPage) {
+        pageInfo {
+            hasNextPage
+        }
+        staff(id_in: $staffIds) {
+            id
+            name {
+                full
+            }
+        }
+    }
+}''')
+
+
+def get_staff_names(staff_ids):
+    """Given an iterable of staff (including VA) IDs, return a dict of their names, formatted as id: "name"."""
+    staff_ids = list(staff_ids)
+    if not staff_ids:  # An empty id_in filter would match every staff member
+        return {}
+
+    return {staff['id']: staff['name']['full']
+            for staff in depaginated_request(query=STAFF_NAMES_QUERY, variables={'staffIds': staff_ids})}
+
+
+def get_show_voice_actors(show_id, language="JAPANESE"):
+    """Given a show ID, return a dict of its voice actors for the given language (default: "JAPANESE"), formatted as:
+    id: {"roles": ["MAIN: Edward Elric", "SUPPORTING: Edward Elric (child)"]}.
+    VA names aren't included, to keep responses small; use get_staff_names for any that are needed.
+    """
+    return vas_dict_from_edges(depaginated_request(query=SHOW_CHARACTERS_QUERY,
+                                                   variables={'mediaId': show_id, 'language': language}))
+
+
+def vas_dict_from_edges(edges):
+    """Given the edges of a Media.characters query, return a dict of VAs formatted as in get_show_voice_actors."""
     vas_dict = {}
 
-    for edge in depaginated_request(query=query, variables={'mediaId': show_id, 'language': language}):
+    for edge in edges:
         for va_role in edge['voiceActorRoles']:
             # Account for VAs potentially having multiple roles
             if va_role['voiceActor']['id'] not in vas_dict:
-                vas_dict[va_role['voiceActor']['id']] = {'name': va_role['voiceActor']['name']['full'],
-                                                         'roles': []}
+                vas_dict[va_role['voiceActor']['id']] = {'roles': []}
 
             role_descr = edge['role'] + " " + edge['node']['name']['full']
             if va_role['roleNotes'] is not None:
@@ -157,12 +241,102 @@ query ($mediaId: Int, $language: StaffLanguage, $page: Int, $perPage: Int) {
     return vas_dict
 
 
-def get_production_staff_shows(staff_id):
-    """Given a staff id, return a dict of shows they've been a production staff member for and the corresponding roles.
-    Formatted as {show_id: {'title': "...",
-                            'roles': ["role1", "role2"]}}
+def get_show_bundle(show_id, language="JAPANESE"):
+    """Given a show ID, return a dict of its studios, production staff, and voice actors (for the given language),
+    formatted as {"studios": {...}, "production_staff": {...}, "voice_actors": {...}} with the same sub-dict formats as
+    get_show_studios, get_show_production_staff, and get_show_voice_actors respectively.
+
+    Fetches all three (including the first page of staff and characters) in a single request, only sending follow-up
+    requests for shows with more staff or characters than fit on one page.
+    """
+    return get_show_bundles([show_id], language=language)[0]
+
+
+SHOW_BUNDLE_FIELDS = minify_query('''
+studios {
+    edges {
+        node {
+            id
+            name
+        }
+        isMain
+    }
+}
+staff(sort: RELEVANCE, page: $page, perPage: $perPage) {
+    pageInfo {
+        hasNextPage
+    }
+    edges {
+        node {
+            id
+        }
+        role
+    }
+}
+characters(sort: [ROLE, RELEVANCE], page: $page, perPage: $perPage) {
+    pageInfo {
+        hasNextPage
+    }
+    edges {
+        node {  # Character
+            name {
+                full
+            }
+        }
+        role  # MAIN, SUPPORTING, or BACKGROUND
+        voiceActorRoles(language: $language) {  # This is a list, but the API doesn't make us paginate it
+            voiceActor {
+                id
+            }
+            roleNotes
+        }
+    }
+}
+''')
+
+
+def get_show_bundles(show_ids, language="JAPANESE"):
+    """Given a list of show IDs, return a list of their studios/staff/VAs dicts, as in get_show_bundle.
+    The first page of every show's data is fetched in as few requests as possible.
     """
-    query = '''
+    # Each show's assembled bundle is cached as a single entry, so its merged first page and follow-up pages can't come
+    # from separate cache entries fetched at different times
+    cache_keys = [{'fields': SHOW_BUNDLE_FIELDS, 'mediaId': show_id, 'language': language} for show_id in show_ids]
+    bundles = [get_cached(cache_key, LONG_CACHE_TTL) for cache_key in cache_keys]
+    uncached = [i for i, bundle in enumerate(bundles) if bundle is None]
+
+    results = batched_media_query(media_args="id: $mediaId",
+                                  fields=SHOW_BUNDLE_FIELDS,
+                                  variables_list=[{'mediaId': show_ids[i]} for i in uncached],
+                                  variable_types={'mediaId': "Int", 'language': "StaffLanguage",
+                                                  'page': "Int", 'perPage': "Int"},
+                                  shared_variables={'language': language, 'page': 1, 'perPage': MAX_PAGE_SIZE},
+                                  cacheable=False)
+
+    for i, media in zip(uncached, results):
+        show_id = show_ids[i]
+
+        # Page 1 came with the merged query, so only the remaining pages (if any) need follow-up queries
+        staff_edges = media['staff']['edges']
+        if media['staff']['pageInfo']['hasNextPage']:
+            staff_edges.extend(depaginated_request(query=SHOW_STAFF_QUERY, variables={'mediaId': show_id},
+                                                   start_page=2, cacheable=False))
+
+        character_edges = media['characters']['edges']
+        if media['characters']['pageInfo']['hasNextPage']:
+            character_edges.extend(depaginated_request(query=SHOW_CHARACTERS_QUERY,
+                                                       variables={'mediaId': show_id, 'language': language},
+                                                       start_page=2, cacheable=False))
+
+        bundles[i] = {'studios': studios_dict_from_edges(media['studios']['edges']),
+                      'production_staff': staff_dict_from_edges(staff_edges),
+                      'voice_actors': vas_dict_from_edges(character_edges)}
+        set_cached(cache_keys[i], bundles[i])
+
+    return bundles
+
+
+STAFF_SHOWS_QUERY = minify_query('''
 query ($staffId: Int, $page: Int, $perPage: Int) {
     Staff(id: $staffId) {
         staffMedia(type: ANIME, sort: POPULARITY_DESC, page: $page, perPage: $perPage) {
@@ -181,10 +355,17 @@ query ($staffId: Int, $page: Int, $perPage: Int) {
             }
         }
     }
-}'''
+}''')
+
+
+def get_production_staff_shows(staff_id):
+    """Given a staff id, return a dict of shows they've been a production staff member for and the corresponding roles.
+    Formatted as {show_id: {'title': "...",
+                            'roles': ["role1", "role2"]}}
+    """
     shows_dict = {}
 
-    for edge in depaginated_request(query=query, variables={'staffId': staff_id}):
+    for edge in depaginated_request(query=STAFF_SHOWS_QUERY, variables={'staffId': staff_id}):
         show = edge['node']
         # Account for staff potentially having multiple roles in a show
         if show['id'] not in shows_dict:
@@ -198,9 +379,7 @@ query ($staffId: Int, $page: Int, $perPage: Int) {
     return shows_dict
 
 
-def get_related_shows(show_id):
-    """Given a show ID, return a set of IDs for all shows that are directly or indirectly related to it."""
-    query = '''
+RELATED_SHOWS_QUERY = minify_query('''
 query ($mediaId: Int) {
     Media(id: $mediaId) {
         relations {  # Has pageInfo but doesn't accept page args
@@ -221,13 +400,17 @@ query ($mediaId: Int) {
             }
         }
     }
-}'''
+}''')
+
+
+def get_related_shows(show_id):
+    """Given a show ID, return a set of IDs for all shows that are directly or indirectly related to it."""
     # TODO: Ignore 'CHARACTER' relation type?
     queue = {show_id}
     related_show_ids = {show_id}  # Including itself to start avoids special-casing
     while queue:
         cur_show_id = queue.pop()
-        relations = safe_post_request({'query': query,
+        relations = safe_post_request({'query': RELATED_SHOWS_QUERY,
                                        'variables': {'mediaId': cur_show_id}})['Media']['relations']['edges']
         for relation in relations:
             # Manga don't need to be included in the output and ignoring them trims our search queries way down
@@ -261,21 +444,24 @@ if __name__ == '__main__':
     parser.add_argument('--ignore-related', action='store_true',
                         help="Ignore directly or indirectly related shows (sequels, prequels, OVAs, etc.) when\n"
                              "searching for similar shows")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't read or write the local cache of AniList API responses.")
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help="Ignore any cached AniList API responses, re-fetching (and re-caching) them.")
     args = parser.parse_args()
 
+    safe_post_request.use_cache = not args.no_cache
+    safe_post_request.refresh_cache = args.refresh_cache
+
     # Lookup each show by name and collect studios/staff/VAs data from them
-    shows = []
-    for show_name in args.show_names:
-        # Get the exact show ID and title based on the given approximate name
-        show = get_show(show_name, sort_by='POPULARITY_DESC' if args.popularity else 'SEARCH_MATCH')
+    shows = get_shows(args.show_names, sort_by='POPULARITY_DESC' if args.popularity else 'SEARCH_MATCH')
+    for show_name, show in zip(args.show_names, shows):
         if show is None:
-            raise ValueError(f"Could not find show matching {show}")
+            raise ValueError(f"Could not find show matching {show_name}")
 
-        # Add data on studios, production staff, and vas
-        show['studios'] = get_show_studios(show['id'])
-        show['production_staff'] = get_show_production_staff(show['id'])
-        show['voice_actors'] = get_show_voice_actors(show['id'], language="JAPANESE")
-        shows.append(show)
+    # Add data on studios, production staff, and vas
+    for show, show_bundle in zip(shows, get_show_bundles([show['id'] for show in shows], language="JAPANESE")):
+        show.update(show_bundle)
 
     # If given only one show, find the show with the most shared production staff and compare it
     # TODO: Also find anime by similarity of animation staff vs script/directors vs music vs VAs
@@ -291,12 +477,10 @@ if __name__ == '__main__':
             if len(ignored_show_ids) > 1:
                 print(f"Ignoring {len(ignored_show_ids) - 1} related show(s)\n")
 
-        # Query each staff member for the IDs of all anime they've had production roles in and keep a tally
-        # TODO: This takes prohibitively many queries. We can be more clever and exit slightly early once a show is in
-        #       the lead by >= num_remaining_staff (or if we list top N, when the Nth is that far ahead of (N + 1)th).
-        #       After exiting early if we want the exact staff counts we can query the top shows directly for their
-        #       staff, which takes far fewer queries.
-        #       We can also query the top N shows directly fairly early so we know their true counts and the cutoff
+        # Query each staff member for the IDs of all anime they've had production roles in and keep a tally.
+        # To save queries, exit early once the top N shows are locked in, i.e. the Nth is ahead of the (N + 1)th by at
+        # least the number of staff remaining to be checked, then query the top shows directly for their exact counts.
+        # TODO: We can also query the top N shows directly fairly early so we know their true counts and the cutoff
         #       point will be detected sooner, fully querying any show that enters the top N. However this gets
         #       complicated by multiple tracked categories so may not be worth it (categories like 'writing' tend to
         #       have only 1-2 overlaps per show at most so won't be able to early exit).
@@ -308,28 +492,51 @@ if __name__ == '__main__':
 
         # Keep a dict of show IDs -> titles we encounter along the way for convenience
         ids_to_titles = {}
-        for staff_id, staff_info in show['production_staff'].items():
-            roles = staff_info['roles']
-            # Find all shows this staff member has had production roles in
-            show_roles = get_production_staff_shows(staff_id)  # dict of show_id: {title: "...", roles: [...]}
-            ids_to_titles.update((k, v['title']) for k, v in show_roles.items())  # Track titles for future ref
-
-            show_counts.update(show_id for show_id in show_roles.keys() if show_id not in ignored_show_ids)
-
-            # For each class of role, tally shows where the staff member has previously had the same class of role
-            trimmed_roles = [staff_types.trim_role(role) for role in roles]
-            for role, trimmed_role in zip(roles, trimmed_roles):
-                if trimmed_role not in staff_types.all_:
-                    print(f"Ignoring unknown role {role}")
-
-            for type_counter, roles_of_type in [[music_show_counts, staff_types.music],
-                                                [visuals_show_counts, staff_types.visuals],
-                                                [writing_show_counts, staff_types.writing]]:
-                if any(role in roles_of_type for role in trimmed_roles):
-                    # This is expensive but will typically only be hit once per staff
-                    type_counter.update(show_id for show_id, v in show_roles.items()
-                                        if (show_id not in ignored_show_ids
-                                            and any(staff_types.trim_role(r) in roles_of_type for r in v['roles'])))
+        staff_items = list(show['production_staff'].items())
+        num_staff_checked = 0
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Check the staff in chunks of one lookup per worker, so we can test for an early exit between chunks
+            while num_staff_checked < len(staff_items):
+                staff_chunk = staff_items[num_staff_checked:num_staff_checked + MAX_WORKERS]
+                # Find all shows each staff member has had production roles in. The lookups are independent so run
+                # them concurrently; map() still yields results in staff order
+                all_show_roles = list(executor.map(get_production_staff_shows,
+                                                   (staff_id for staff_id, _ in staff_chunk)))
+
+                # Tally the whole chunk in one pass (iterating the dicts yields their show IDs), then drop ignored shows
+                show_counts.update(chain.from_iterable(all_show_roles))
+                for show_id in ignored_show_ids:
+                    show_counts.pop(show_id, None)
+
+                # show_roles: dict of show_id: {title: "...", roles: [...]}
+                for (_, staff_info), show_roles in zip(staff_chunk, all_show_roles):
+                    roles = staff_info['roles']
+                    ids_to_titles.update((k, v['title']) for k, v in show_roles.items())  # Track titles for future ref
+
+                    # For each class of role, tally shows where the staff member has previously had the same class of
+                    # role
+                    role_categories = [staff_types.classify(role) for role in roles]
+                    for role, category in zip(roles, role_categories):
+                        if category is None:
+                            print(f"Ignoring unknown role {role}")
+
+                    for type_counter, category in [[music_show_counts, "music"],
+                                                   [visuals_show_counts, "visuals"],
+                                                   [writing_show_counts, "writing"]]:
+                        if category in role_categories:
+                            # This is expensive but will typically only be hit once per staff
+                            type_counter.update(show_id for show_id, v in show_roles.items()
+                                                if (show_id not in ignored_show_ids
+                                                    and any(staff_types.classify(r) == category for r in v['roles'])))
+
+                num_staff_checked += len(staff_chunk)
+
+                # Check if the remaining staff could still change which shows are in the top N
+                top_counts = [count for _, count in show_counts.most_common(args.top + 1)]
+                if (num_staff_checked < len(staff_items) and len(top_counts) >= args.top
+                        and top_counts[args.top - 1] - (top_counts[args.top] if len(top_counts) > args.top else 0)
+                        >= len(staff_items) - num_staff_checked):
+                    break
 
         if not show_counts:
             print(f"Staff for {show['title']} have not done any other shows.")
@@ -339,18 +546,33 @@ if __name__ == '__main__':
         # Make sure to ignore the given show as it will always have the most matches. However check for its ID instead
         # of blindly skipping the top match, just in case of ties (e.g. an unreleased show with very few staff listed
         # might be completely supersetted).
-        top_shows = show_counts.most_common(args.top)
+        if num_staff_checked < len(staff_items):
+            print(f"Top {args.top} shows found after checking {num_staff_checked}/{len(staff_items)} staff; other"
+                  f" tallies may be incomplete.\n")
+
+        # The tallies only say how many of our staff credit themselves on each show, so refine the finalists (plus one
+        # runner-up, in case it overtakes) by fetching their staff directly and counting the exact overlap. Doing this
+        # only for the finalists costs just a few extra queries
+        candidate_shows = show_counts.most_common(args.top + 1)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            candidates_staff_ids = executor.map(get_show_production_staff_ids,
+                                                (show_id for show_id, _ in candidate_shows))
+            # List of (show_id, exact_count, tallied_count)
+            top_shows = [(show_id, len(show['production_staff'].keys() & staff_ids), tallied_count)
+                         for (show_id, tallied_count), staff_ids in zip(candidate_shows, candidates_staff_ids)]
+        top_shows.sort(key=lambda x: (x[1], x[2]), reverse=True)
+        top_shows = top_shows[:args.top]
+
         # Add the top show by total production staff for comparison
         other_show_id = top_shows[0][0]
         shows.append({'id': other_show_id,
                       'title': ids_to_titles[other_show_id],
-                      'studios': get_show_studios(other_show_id),
-                      'production_staff': get_show_production_staff(other_show_id),
-                      'voice_actors': get_show_voice_actors(other_show_id, language="JAPANESE")})
+                      **get_show_bundle(other_show_id, language="JAPANESE")})
 
-        print(f"Shows with most production staff in common with {show['title']}:")
-        for other_show_id, shared_staff_count in top_shows:
-            print(f"    {shared_staff_count:2} | {ids_to_titles[other_show_id][:2 * SHOW_COL_WIDTH]}")
+        print(f"Shows with most production staff in common with {show['title']} (exact / tallied from staff credits):")
+        for other_show_id, shared_staff_count, tallied_count in top_shows:
+            print(f"    {shared_staff_count:2} / {tallied_count:2}"
+                  f" | {ids_to_titles[other_show_id][:2 * SHOW_COL_WIDTH]}")
         print("")
 
         # Report the top 3 matching shows for each subcategory
@@ -382,20 +604,28 @@ if __name__ == '__main__':
     col_widths = [STAFF_COL_WIDTH] + [SHOW_COL_WIDTH] * len(shows)
     total_width = sum(col_widths) + COL_SEP * (len(col_widths) - 1)  # Adjust for separator
 
+    col_format = (COL_SEP * ' ').join(f"{{:<{col_width}.{col_width}}}" for col_width in col_widths)
+
     def col_print(items):
         """Print the given strings left-justified in the appropriate width columns, truncating them if too long."""
-        print((COL_SEP * ' ').join(item[:col_width].ljust(col_width) for item, col_width in zip(items, col_widths)))
+        print(col_format.format(*items))
 
     col_print([""] + [show['title'] for show in shows])
 
     # List common studios/staff, sectioned separately by studios vs production staff vs voice actors
-    common_found = False
-    for staff_type, show_staff_dicts in [["Studios", [show['studios'] for show in shows]],
-                                         ["Production Staff", [show['production_staff'] for show in shows]],
-                                         ["Voice Actors (JP)", [show['voice_actors'] for show in shows]]]:
-        # Find the common staff between the shows. Use a helper to avoid sets so that dict ordering is maintained
-        common_staff_ids = dict_intersection(show_staff_dicts)
+    sections = [["Studios", [show['studios'] for show in shows]],
+                ["Production Staff", [show['production_staff'] for show in shows]],
+                ["Voice Actors (JP)", [show['voice_actors'] for show in shows]]]
+    # Find the common staff between the shows. Use a helper to avoid sets so that dict ordering is maintained
+    sections_common_ids = [dict_intersection(show_staff_dicts) for _, show_staff_dicts in sections]
 
+    # Staff/VA names aren't fetched with the shows' staff lists, so look up just the ones we'll list
+    staff_names = get_staff_names(set().union(*sections_common_ids[1:]))
+    studio_names = {studio_id: studio['name'] for studio_id, studio in shows[0]['studios'].items()}
+
+    common_found = False
+    for (staff_type, show_staff_dicts), common_staff_ids, names in zip(sections, sections_common_ids,
+                                                                       [studio_names, staff_names, staff_names]):
         if common_staff_ids:
             if common_found:  # Quick hack to avoid leading newlines
                 print("\n")
@@ -408,7 +638,8 @@ if __name__ == '__main__':
                 # Print a row(s) with the staff name followed by their role(s) in each show
                 max_roles = max(len(show_staff[staff_id]['roles']) for show_staff in show_staff_dicts)
                 for i in range(max_roles):
-                    cols = [show_staff_dicts[0][staff_id]['name'] if i == 0 else ""]
+                    # Fall back to the ID in case the name lookup came back without them (e.g. a since-deleted staff)
+                    cols = [names.get(staff_id, str(staff_id)) if i == 0 else ""]
                     cols.extend((show_staff[staff_id]['roles'][i] if i < len(show_staff[staff_id]['roles']) else "")
                                 for show_staff in show_staff_dicts)
                     col_print(cols)
@@ -2,7 +2,8 @@ import argparse
 import json
 import random
 
-from .utils import URL, MAX_PAGE_SIZE, safe_post_request, depaginated_request
+from .utils import URL, MAX_PAGE_SIZE, minify_query, safe_post_request, depaginated_request
+from .upcoming_sequels import get_user_id_by_name
 
 # Metrics to track and return top 5 of, in terms of shared completed shows:
 # similarity score (normalizing for mean and standard deviation, where SD is measured with the max/min scores in mind
@@ -20,21 +21,7 @@ from .utils import URL, MAX_PAGE_SIZE, safe_post_request, depaginated_request
 # }
 
 
-def get_user_id_by_name(username):
-    """Given an AniList username, fetch the user's ID."""
-    query_user_id = '''
-query ($username: String) {
-    User (name: $username) {
-        id
-    }
-}'''
-
-    return safe_post_request({'query': query_user_id, 'variables': {'username': username}})['User']['id']
-
-
-def get_user_completed_scores(user_id):
-    """Given an AniList user ID, fetch the user's completed anime list, returning a dict of show_ID: score."""
-    query_completed_list = '''
+COMPLETED_SCORES_QUERY = minify_query('''
 query ($userId: Int, $page: Int, $perPage: Int) {
     Page (page: $page, perPage: $perPage) {
         pageInfo {
@@ -51,15 +38,16 @@ query ($userId: Int, $page: Int, $perPage: Int) {
             score
         }
     }
-}'''
+}''')
 
+
+def get_user_completed_scores(user_id):
+    """Given an AniList user ID, fetch the user's completed anime list, returning a dict of show_ID: score."""
     return {list_entry['mediaId']: list_entry['score']
-            for list_entry in depaginated_request(query=query_completed_list, variables={'userId': user_id})}
+            for list_entry in depaginated_request(query=COMPLETED_SCORES_QUERY, variables={'userId': user_id})}
 
 
-def get_followed_users(user_id):
-    """Return a list of users followed by the given user ID."""
-    query_followed = '''
+FOLLOWED_USERS_QUERY = minify_query('''
 query ($userId: Int!, $page: Int, $perPage: Int) {
     Page (page: $page, perPage: $perPage) {
         pageInfo {
@@ -70,15 +58,15 @@ query ($userId: Int!, $page: Int, $perPage: Int) {
             name
         }
     }
-}'''
+}''')
 
-    return depaginated_request(query=query_followed, variables={'userId': user_id})
 
+def get_followed_users(user_id):
+    """Return a list of users followed by the given user ID."""
+    return list(depaginated_request(query=FOLLOWED_USERS_QUERY, variables={'userId': user_id}))
 
-def get_50_random_users():
-    """"""
-    # Pick a random page of users
-    query_users = '''
+
+USERS_QUERY = minify_query('''
 query ($page: Int, $perPage: Int) {
     Page (page: $page, perPage: $perPage) {
         pageInfo {
@@ -90,15 +78,20 @@ query ($page: Int, $perPage: Int) {
             name
         }
     }
-}
-'''
+}''')
+
+
+def get_50_random_users():
+    """"""
+    # Pick a random page of users
     # Send a preliminary request to determine how many pages there are (hopefully won't decrease between requests...)
-    response_data = safe_post_request({'query': query_users, 'variables': {'page': 1, 'perPage': MAX_PAGE_SIZE}})
+    response_data = safe_post_request({'query': USERS_QUERY, 'variables': {'page': 1, 'perPage': MAX_PAGE_SIZE}})
     # TODO: lastPage seems to be broken, this might be restricting which pages we get or getting empty pages
     rand_page = random.randint(1, response_data['Page']['pageInfo']['lastPage'])
 
     # Fetch a random page and return its users
-    response_data = safe_post_request({'query': query_users, 'variables': {'page': rand_page, 'perPage': MAX_PAGE_SIZE}})
+    response_data = safe_post_request({'query': USERS_QUERY,
+                                       'variables': {'page': rand_page, 'perPage': MAX_PAGE_SIZE}})
 
     return response_data['Page']['users']
 
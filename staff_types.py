@@ -2,10 +2,12 @@
 
 Note that staff roles normally have a (ep N) or (OP/ED) suffix which should be removed."""
 
+from functools import lru_cache
+
 # Words that can be omitted without losing the gist of which production area they're in, if they're not the only word
 # things like 'of' are included to trim e.g. "Director of Photography" -> "Photography"
-ignorable_keywords = {"of", "Chief", "Director", "Executive", "Producer", "Supervisor", "Manager", "Main",
-                      "Assistant", "Assistance", "Associate"}  # TODO: 'Original' too, maybe
+ignorable_keywords = frozenset({"of", "Chief", "Director", "Executive", "Producer", "Supervisor", "Manager", "Main",
+                                "Assistant", "Assistance", "Associate"})  # TODO: 'Original' too, maybe
 
 theme_songs = {"Theme Song Performance", "Theme Song Composition", "Theme Song Arrangement"}
 ost = {"Music", "Music Production",
@@ -51,7 +53,20 @@ misc = {"Producer", "Production", "Supervisor", "Assistance",
 
 all_ = audio | visuals | writing | directing | marketing | misc
 
+# Inverted mapping of each (trimmed) role to the name of its category, so a role can be classified with one lookup.
+# Categories are disjoint, but in case of future overlaps, earlier categories take precedence
+category_of_role = {role: category
+                    for category, roles in reversed([("music", music),
+                                                     ("sound", sound),
+                                                     ("visuals", visuals),
+                                                     ("writing", writing),
+                                                     ("directing", directing),
+                                                     ("marketing", marketing),
+                                                     ("misc", misc)])
+                    for role in roles}
+
 
+@lru_cache(maxsize=4096)  # The same roles come up over and over across staff and shows
 def trim_role(role: str):
     """Given a production staff role, trim any words/info from it that don't aid in classifying its staff type.
     This includes:
@@ -66,3 +81,10 @@ def trim_role(role: str):
     # Drop meaningless words, unless this would remove all words in which case keep the last
     trimmed_role = " ".join(word for word in role.split() if word and word not in ignorable_keywords)
     return trimmed_role if trimmed_role else role.split()[-1]
+
+
+def classify(role: str):
+    """Given a production staff role, return the name of its category (e.g. "music", "visuals", "writing"), or None if
+    it is an unknown role.
+    """
+    return category_of_role.get(trim_role(role))
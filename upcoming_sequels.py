@@ -3,24 +3,23 @@
 import argparse
 from datetime import datetime
 
-from .utils import safe_post_request, depaginated_request
+from .utils import minify_query, safe_post_request, depaginated_request
 
 
-def get_user_id_by_name(username):
-    """Given an AniList username, fetch the user's ID."""
-    query_user_id = '''
+USER_ID_QUERY = minify_query('''
 query ($username: String) {
     User (name: $username) {
         id
     }
-}'''
+}''')
 
-    return safe_post_request({'query': query_user_id, 'variables': {'username': username}})['User']['id']
+
+def get_user_id_by_name(username):
+    """Given an AniList username, fetch the user's ID."""
+    return safe_post_request({'query': USER_ID_QUERY, 'variables': {'username': username}})['User']['id']
 
 
-def get_user_media(user_id, status='COMPLETED'):
-    """Given an AniList user ID, fetch the user's anime list, returning a list of show IDs sorted by score (desc)."""
-    query = '''
+USER_MEDIA_QUERY = minify_query('''
 query ($userId: Int, $status: MediaListStatus, $page: Int, $perPage: Int) {
     Page (page: $page, perPage: $perPage) {
         pageInfo {
@@ -37,15 +36,16 @@ query ($userId: Int, $status: MediaListStatus, $page: Int, $perPage: Int) {
             }
         }
     }
-}'''
+}''')
+
 
-    return [list_entry['media'] for list_entry in depaginated_request(query=query,
+def get_user_media(user_id, status='COMPLETED'):
+    """Given an AniList user ID, fetch the user's anime list, returning a list of show IDs sorted by score (desc)."""
+    return [list_entry['media'] for list_entry in depaginated_request(query=USER_MEDIA_QUERY,
                                                                       variables={'userId': user_id, 'status': status})]
 
 
-def get_season_shows(season: str, season_year: int) -> list:
-    """Given a season (WINTER, SPRING, SUMMER, FALL) and year, return a list of shows from that season."""
-    query = '''
+SEASON_SHOWS_QUERY = minify_query('''
 query ($season: MediaSeason, $seasonYear: Int, $page: Int, $perPage: Int) {
     Page (page: $page, perPage: $perPage) {
         pageInfo {
@@ -60,8 +60,12 @@ query ($season: MediaSeason, $seasonYear: Int, $page: Int, $perPage: Int) {
             }
         }
     }
-}'''
-    return depaginated_request(query=query, variables={'season': season, 'seasonYear': season_year})
+}''')
+
+
+def get_season_shows(season: str, season_year: int) -> list:
+    """Given a season (WINTER, SPRING, SUMMER, FALL) and year, return a list of shows from that season."""
+    return list(depaginated_request(query=SEASON_SHOWS_QUERY, variables={'season': season, 'seasonYear': season_year}))
 
 
 def fuzzy_date_greater_or_equal_to(fuzzy_date, date: datetime):
@@ -78,14 +82,7 @@ def fuzzy_date_greater_or_equal_to(fuzzy_date, date: datetime):
     return True
 
 
-def get_related_media(show_id):
-    """Given a media ID, return a set of IDs for all airing or future anime that are direct or indirect relations of it.
-
-    Also return their airing season and relation type.
-
-    Optionally provide a set of media IDs to ignore (e.g. also going to be searched) to cut query count.
-    """
-    query = '''
+RELATED_MEDIA_QUERY = minify_query('''
 query ($mediaId: Int) {
     Media(id: $mediaId) {
         relations {  # Has pageInfo but doesn't accept page args
@@ -106,13 +103,22 @@ query ($mediaId: Int) {
             }
         }
     }
-}'''
+}''')
+
+
+def get_related_media(show_id):
+    """Given a media ID, return a set of IDs for all airing or future anime that are direct or indirect relations of it.
+
+    Also return their airing season and relation type.
+
+    Optionally provide a set of media IDs to ignore (e.g. also going to be searched) to cut query count.
+    """
     queue = {show_id}
     related_show_ids = {show_id}  # Including itself to start avoids special-casing
     returned_shows = []
     while queue:
         cur_show_id = queue.pop()
-        relations = safe_post_request({'query': query,
+        relations = safe_post_request({'query': RELATED_MEDIA_QUERY,
                                        'variables': {'mediaId': cur_show_id}})['Media']['relations']['edges']
         for relation in relations:
             show = relation['node']
@@ -1,85 +1,341 @@
 import requests
+from requests.adapters import HTTPAdapter
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import dbm
+import hashlib
+import json
+import os
+import re
+import shelve
+import threading
 import time
 
+try:  # Optional, but decodes the API's large JSON responses faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 URL = 'https://graphql.anilist.co'
 MAX_PAGE_SIZE = 50  # The anilist API's max page size
+MAX_MEDIA_BATCH_SIZE = 5  # Max aliased Media fields per batched query, to stay under the API's query complexity limit
+REQUEST_TIMEOUT = 30  # Seconds
+MAX_CONCURRENT_REQUESTS = 8  # Max in-flight requests across all threads, regardless of how callers fan out
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'anilist_tools', 'responses')
+CACHE_TTL = 24 * 60 * 60  # Seconds; used for e.g. searches and user lists, which change often
+LONG_CACHE_TTL = 7 * 24 * 60 * 60  # Seconds; used for Staff/Media looked up by ID, which rarely change
+
+# Share one session across all requests so the connection to the API is kept alive instead of redoing the TLS handshake
+# for every query
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_REQUESTS))
+_QUERY_COUNT_LOCK = threading.Lock()
+_REQUEST_SEMAPHORE = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+# When the rate limit is hit, every thread backs off until this time, instead of each worker separately hitting it
+_rate_limited_until = 0  # Epoch seconds
+_RATE_LIMIT_LOCK = threading.Lock()
+_PRINT_LOCK = threading.Lock()  # Keeps overlapping rate limit messages from garbling each other
+
+_cache = None  # Opened on first use
+_CACHE_LOCK = threading.Lock()  # shelve doesn't support concurrent access
+
+
+def _cache_ttl(query):
+    """Given a query string, return how long its response should be cached for."""
+    # Matches both plain and aliased fields, e.g. "Staff(id: $staffId)" or "m0: Media(id: $mediaId0)"
+    if re.search(r'\b(Staff|Media)\s*\(\s*id\s*:', query):
+        return LONG_CACHE_TTL
+
+    return CACHE_TTL
+
+
+def _cache_get(key, ttl):
+    """Return the cached (timestamp, data) entry for the given key, or None if it is missing or older than ttl.
+    Expired entries are deleted, so the cache file doesn't keep growing with responses that will never be used.
+    """
+    with _CACHE_LOCK:
+        cache = _get_cache()
+        if cache is None:
+            return None
+
+        entry = cache.get(key)
+        if entry is not None and time.time() - entry[0] > ttl:
+            del cache[key]
+            return None
+
+    return entry
+
+
+def _cache_set(key, data):
+    """Cache the given response data under the given key, timestamped with the current time."""
+    with _CACHE_LOCK:
+        cache = _get_cache()
+        if cache is not None:
+            cache[key] = (time.time(), data)
+
+
+def _get_cache():
+    """Return the on-disk response cache, opening it if needed, or None if it couldn't be opened (in which case caching
+    is disabled for the rest of the run). Must be called with _CACHE_LOCK held.
+    """
+    global _cache
+    if _cache is None and safe_post_request.use_cache:
+        try:
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+            _cache = shelve.open(CACHE_PATH)
+        except dbm.error as e:  # Includes OSError; e.g. a corrupt cache file, or one written by another dbm backend
+            print(f"Could not open the response cache at {CACHE_PATH}, continuing without it: {e}")
+            safe_post_request.use_cache = False
+            return None
+
+        atexit.register(_cache.close)
+
+    return _cache
+
+
+def minify_query(query):
+    """Given a GraphQL query string, strip its comments and any unneeded whitespace to shrink the request body."""
+    query = re.sub(r'#.*', '', query)  # Drop comments
+    query = re.sub(r'\s*([{}()\[\]:,])\s*', r'\1', query)  # Drop whitespace around punctuation
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def _cache_key(request_json):
+    """Given the JSON describing a request, return a stable key for caching its response under."""
+    return hashlib.sha256(json.dumps(request_json, sort_keys=True).encode()).hexdigest()
+
+
+def _cache_enabled(query, oauth_token):
+    """Return whether responses to the given query should be read from/written to the cache."""
+    # Authenticated responses are per-user, and mutations must always actually be sent
+    return safe_post_request.use_cache and oauth_token is None and not query.lstrip().startswith('mutation')
+
+
+def _wait_for_rate_limit():
+    """Sleep until any rate limit block set by _block_for_rate_limit (possibly from another thread) has passed."""
+    while True:
+        with _RATE_LIMIT_LOCK:
+            wait_time = _rate_limited_until - time.time()
+
+        if wait_time <= 0:
+            return
+
+        time.sleep(wait_time)
+
+
+def _block_for_rate_limit(retry_after, verbose=True):
+    """Block requests from all threads for the next retry_after seconds, then wait for the block to pass.
+    Only the thread that started the block prints the rate limit message, so concurrent workers don't garble it.
+    """
+    global _rate_limited_until
+    with _RATE_LIMIT_LOCK:
+        now = time.time()
+        started_block = _rate_limited_until <= now
+        _rate_limited_until = max(_rate_limited_until, now + retry_after)
+
+    if not (started_block and verbose and retry_after >= 1):
+        _wait_for_rate_limit()
+        return
 
+    with _PRINT_LOCK:
+        retry_msg = f"Rate limit encountered; waiting {retry_after} seconds..."
+        print(retry_msg, end='', flush=True)  # No trailing newline so we can overwrite this printout
 
-def safe_post_request(post_json, oauth_token=None, verbose=True):
+        _wait_for_rate_limit()
+
+        # Write back over the rate limit message with whitespace
+        print('\r' + len(retry_msg) * " ", end='\r', flush=True)  # Both '\r' here so cursor looks nice...
+
+
+def _post(post_json, oauth_token):
+    """Send a single post request to the AniList API, waiting for a free slot if too many are already in flight, and
+    for any rate limit block to pass.
+    """
+    _wait_for_rate_limit()
+    with _REQUEST_SEMAPHORE:  # Held only while the request is in flight, not during rate limit waits
+        return _SESSION.post(URL, json=post_json, headers={'Authorization': oauth_token}, timeout=REQUEST_TIMEOUT)
+
+
+def safe_post_request(post_json, oauth_token=None, verbose=True, cacheable=True):
     """Send a post request to the AniList API, automatically waiting and retrying if the rate limit was encountered.
     Returns the 'data' field of the response. Note that this may be None if the request found nothing (404).
+
+    If safe_post_request.use_cache is set to True (off by default, so library callers always see fresh data), responses
+    to unauthenticated, non-mutation queries are cached on disk (see CACHE_PATH). Set safe_post_request.refresh_cache
+    to True to ignore existing cache entries while still caching new responses. Pass cacheable=False to never cache this
+    particular request, e.g. for requests that are only part of a larger response that the caller caches as a whole.
     """
-    response = requests.post(URL, json=post_json, headers={'Authorization': oauth_token})
+    use_cache = cacheable and _cache_enabled(post_json['query'], oauth_token)
+    if use_cache:
+        cache_key = _cache_key(post_json)
+        if not safe_post_request.refresh_cache:
+            cache_entry = _cache_get(cache_key, _cache_ttl(post_json['query']))
+            if cache_entry is not None:
+                return cache_entry[1]
+
+    response = _post(post_json, oauth_token)
 
     # Handle rate limit
     while response.status_code == 429:
         if 'Retry-After' in response.headers:
             retry_after = int(response.headers['Retry-After']) + 1
-            if verbose:
-                retry_msg = f"Rate limit encountered; waiting {retry_after} seconds..."
-                print(retry_msg, end='', flush=True)  # No trailing newline so we can overwrite this printout
-
-            time.sleep(retry_after)
-
-            # Write back over the rate limit message with whitespace
-            if verbose:
-                print('\r' + len(retry_msg) * " ", end='\r', flush=True)  # Both '\r' here so cursor looks nice...
         else:  # Retry-After should always be present, but have seen it be missing for some users; retry quickly
-            time.sleep(0.1)
-            #print(f"AniList API gave rate limit response without retry time; trying waiting {retry_after} seconds...")
+            retry_after = 0.1
 
-        time.sleep(retry_after)
-        response = requests.post(URL, json=post_json, headers={'Authorization': oauth_token})
+        _block_for_rate_limit(retry_after, verbose)
+        response = _post(post_json, oauth_token)
 
-    safe_post_request.total_queries += 1  # We'll ignore requests that got 429'd
+    with _QUERY_COUNT_LOCK:  # May be called from worker threads
+        safe_post_request.total_queries += 1  # We'll ignore requests that got 429'd
 
     if not response.ok:
         if "errors" in response.json():
             print(response.json()['errors'])
         response.raise_for_status()
 
-    return response.json()['data']
+    data = json_loads(response.content)['data']
+    if use_cache:
+        _cache_set(cache_key, data)
+
+    return data
 
 
 safe_post_request.total_queries = 0  # Spooky property-on-function
+safe_post_request.use_cache = False  # Opted into by scripts that expose the cache flags
+safe_post_request.refresh_cache = False
+
+
+def get_cached(key_json, ttl=CACHE_TTL):
+    """Return the data cached by set_cached under the given JSON-serializable key, or None if caching is disabled, if
+    safe_post_request.refresh_cache is set, or if the entry is missing or older than ttl (seconds).
+    For callers that assemble one result from several requests and want to cache it as a whole.
+    """
+    if not safe_post_request.use_cache or safe_post_request.refresh_cache:
+        return None
+
+    cache_entry = _cache_get(_cache_key(key_json), ttl)
+    return cache_entry[1] if cache_entry is not None else None
+
+
+def set_cached(key_json, data):
+    """If caching is enabled, cache the given data under the given JSON-serializable key. See get_cached."""
+    if safe_post_request.use_cache:
+        _cache_set(_cache_key(key_json), data)
+
+
+def _request_page(query, variables, page_num, oauth_token=None, verbose=True):
+    """Request a single page of a paginated query, returning the unwrapped {"pageInfo": ..., "<results>": [...]} json.
+    See depaginated_request.
+    """
+    response_data = safe_post_request({'query': query, 'variables': {**variables, 'page': page_num,
+                                                                     'perPage': MAX_PAGE_SIZE}},
+                                      oauth_token, verbose=verbose, cacheable=False)  # Cached as a whole instead
+
+    # Blindly unwrap the returned json until we see pageInfo. This unwraps both Page objects and cases where we're
+    # querying a paginated subfield of some other object.
+    # E.g. if querying Media.staff.edges, unwraps "Media" and "staff" to get {"pageInfo":... "edges"...}
+    while 'pageInfo' not in response_data:
+        assert response_data, "Could not find pageInfo in paginated request."
+        assert len(response_data) == 1, "Cannot de-paginate query with multiple returned fields."
+
+        response_data = response_data[next(iter(response_data))]  # Unwrap
+
+    assert len(response_data) == 2, "Cannot de-paginate query with multiple returned fields."
+    return response_data
 
 
 # Note that the anilist API's lastPage field of PageInfo is currently broken and doesn't return reliable results
-def depaginated_request(query, variables, oauth_token=None, verbose=True):
-    """Given a paginated query string, request every page and return a list of all the requested objects.
+def depaginated_request(query, variables, oauth_token=None, verbose=True, start_page=1, cacheable=True):
+    """Given a paginated query string, request every page and yield each of the requested objects, one page at a time
+    (so callers can build their own results as pages come in instead of also holding a full list of every object).
 
     Query must return only a single Page or paginated object subfield, and will be automatically unwrapped.
+    Optionally start from a later page, e.g. if the first page was already fetched as part of another query.
+    If caching is enabled (see safe_post_request), the full list of results is cached as a single entry rather than per
+    page, so a partially expired cache can't stitch together pages fetched at different times (which could duplicate
+    or drop objects that moved between pages in the meantime). Pass cacheable=False to skip the cache, e.g. if the
+    caller caches a larger result that these pages are part of.
     """
-    paginated_variables = {
-        **variables,
-        'perPage': MAX_PAGE_SIZE
-    }
+    use_cache = cacheable and _cache_enabled(query, oauth_token)
+    if use_cache:
+        cache_key = _cache_key({'query': query, 'variables': variables, 'start_page': start_page, 'depaginated': True})
+        if not safe_post_request.refresh_cache:
+            cache_entry = _cache_get(cache_key, _cache_ttl(query))
+            if cache_entry is not None:
+                yield from cache_entry[1]
+                return
 
-    out_list = []
+        all_results = []
 
-    page_num = 1  # Note that pages are 1-indexed
-    while True:
-        paginated_variables['page'] = page_num
-        response_data = safe_post_request(
-            {'query': query, 'variables': paginated_variables}, oauth_token, verbose=verbose)
+    page_num = start_page  # Note that pages are 1-indexed
+    response_data = _request_page(query, variables, page_num, oauth_token, verbose)
+
+    # Use a background thread to prefetch the next page while the caller processes the current one. It's only started
+    # once a page reports a next page, so the common single-page request stays entirely on the calling thread
+    executor = None
+    try:
+        while True:
+            page_future = None
+            if response_data['pageInfo']['hasNextPage']:
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=1)
+
+                page_num += 1
+                page_future = executor.submit(_request_page, query, variables, page_num, oauth_token, verbose)
 
-        # Blindly unwrap the returned json until we see pageInfo. This unwraps both Page objects and cases where we're
-        # querying a paginated subfield of some other object.
-        # E.g. if querying Media.staff.edges, unwraps "Media" and "staff" to get {"pageInfo":... "edges"...}
-        while 'pageInfo' not in response_data:
-            assert response_data, "Could not find pageInfo in paginated request."
-            assert len(response_data) == 1, "Cannot de-paginate query with multiple returned fields."
+            # Grab the non-PageInfo query result
+            page_results = next(v for k, v in response_data.items() if k != 'pageInfo')
+            if use_cache:
+                all_results.extend(page_results)
 
-            response_data = response_data[next(iter(response_data))]  # Unwrap
+            yield from page_results
 
-        # Grab the non-PageInfo query result
-        assert len(response_data) == 2, "Cannot de-paginate query with multiple returned fields."
-        out_list.extend(next(v for k, v in response_data.items() if k != 'pageInfo'))
+            if page_future is None:
+                break
 
-        if not response_data['pageInfo']['hasNextPage']:
-            return out_list
+            response_data = page_future.result()
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-        page_num += 1
+    # Only reached if the caller consumed every page
+    if use_cache:
+        _cache_set(cache_key, all_results)
+
+
+def batched_media_query(media_args, fields, variables_list, variable_types, shared_variables=None, oauth_token=None,
+                        verbose=True, cacheable=True):
+    """Fetch multiple Media objects with as few requests as possible, by aliasing one Media field per entry of
+    variables_list (e.g. `m0: Media(id: $id0) {...} m1: Media(id: $id1) {...}`).
+
+    media_args is the Media field's argument string (e.g. "id: $mediaId") and fields is its selection set, without the
+    outer braces. variable_types maps every variable name to its GraphQL type (e.g. {'mediaId': "Int"}), for both the
+    per-Media variables in variables_list and any shared_variables, which are sent once for use by all of the fields.
+    Returns a list of the Media results in the same order as variables_list. cacheable is as in safe_post_request.
+    """
+    shared_variables = shared_variables or {}
+    results = []
+
+    for batch_start in range(0, len(variables_list), MAX_MEDIA_BATCH_SIZE):
+        var_defs = [f"${k}: {variable_types[k]}" for k in shared_variables]
+        variables = dict(shared_variables)
+        selections = []
+        for i, media_vars in enumerate(variables_list[batch_start:batch_start + MAX_MEDIA_BATCH_SIZE]):
+            # Suffix each per-Media variable with its alias index, leaving shared variables as-is
+            var_defs.extend(f"${k}{i}: {variable_types[k]}" for k in media_vars)
+            variables.update((f"{k}{i}", v) for k, v in media_vars.items())
+            args = re.sub(r'\$(\w+)', lambda m: f"${m[1]}{i}" if m[1] in media_vars else m[0], media_args)
+            selections.append(f"m{i}: Media({args}) {{{fields}}}")
+
+        query = "query (" + ", ".join(var_defs) + ") {\n" + "\n".join(selections) + "\n}"
+        # Response data may be None if nothing was found
+        response_data = safe_post_request({'query': query, 'variables': variables}, oauth_token, verbose=verbose,
+                                          cacheable=cacheable) or {}
+        results.extend(response_data.get(f"m{i}") for i in range(len(selections)))
+
+    return results
 
 
 def dict_intersection(dicts):
@@ -90,4 +346,9 @@ def dict_intersection(dicts):
     if not dicts:
         return []
 
-    return [k for k in dicts[0] if all(k in d for d in dicts[1:])]
+    # Intersect the key views of the other dicts first so each key of the first dict only needs one lookup
+    common_keys = set(dicts[0])
+    for d in dicts[1:]:
+        common_keys &= d.keys()
+
+    return [k for k in dicts[0] if k in common_keys]